@@ -4,22 +4,25 @@ import warnings
 import logging
 import itertools
 import sys
+import gc
+import contextlib
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
-from functools import partial
-from copy import deepcopy
+from collections import defaultdict, deque, OrderedDict
+from functools import partial, lru_cache
 
 import tqdm
+import joblib
 import numpy as np
 import tensorflow as tf
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import ShuffleSplit
 
 from finetune.download import download_data_if_required
 from finetune.optimizers import AdamWeightDecay, schedules
 from finetune.network_modules import featurizer, language_model
 from finetune.utils import (
-    find_trainable_variables, assign_to_gpu, average_grads, interpolate_pos_embed,
-    iter_data, soft_split, concat_or_stack, sample_with_temperature, list_transpose
+    find_trainable_variables, assign_to_gpu, average_grads, all_reduce_grads, interpolate_pos_embed,
+    iter_data, soft_split, concat_or_stack, sample_with_temperature, fill_token_array,
+    fill_token_array_numpy, ragged_coords
 )
 from finetune.encoding import TextEncoder, ArrayEncodedOutput, EncodedOutput
 from finetune.config import PAD_TOKEN, get_default_config
@@ -33,6 +36,151 @@ DROPOUT_ON = 1
 DROPOUT_OFF = 0
 SAVE_PREFIX = 'model'
 
+# number of recently encoded inputs kept by models with `cache_encodings` set
+_ENCODING_CACHE_SIZE = 4
+
+
+class _MedianPruner:
+    """
+    Decides when to stop a grid search trial early: a trial is stopped after an epoch if its score is below the median
+    of the scores that completed trials had reached after the same number of epochs.
+    """
+
+    def __init__(self, n_startup_trials=1):
+        self.n_startup_trials = n_startup_trials
+        self.history = defaultdict(list)  # epoch -> scores of completed trials after that epoch
+
+    def should_prune(self, epoch, score):
+        completed = self.history[epoch]
+        return len(completed) >= self.n_startup_trials and score < np.median(completed)
+
+    def complete(self, scores):
+        for epoch, score in enumerate(scores, 1):
+            self.history[epoch].append(score)
+
+
+class _ScoreBound:
+    """
+    Decides when a grid search trial can be skipped: a trial is skipped if the upper bound on the score its config can
+    reach is no better than the best score reached so far.
+    """
+
+    def __init__(self, score_upper_bound):
+        self.score_upper_bound = score_upper_bound
+        self.best_score = -np.inf
+
+    def should_skip(self, config):
+        return self.score_upper_bound(config) <= self.best_score
+
+    def complete(self, score):
+        self.best_score = max(self.best_score, score)
+
+
+# config items that only change values fed to the graph while training, so models can be retrained with new values
+_FED_HYPERPARAMETERS = ('lr', 'l2_reg', 'n_epochs')
+
+
+def _grid_search_trial(instance, trainXs, trainY, testXs, testY, eval_fn, probs, pruner=None):
+    """
+    Trains a model on a single grid search configuration and scores it on the held out data.
+    When a pruner is given, the trial is scored after every epoch and stopped as soon as the pruner rejects it, in
+    which case the score at that point is returned.
+    Without an eval_fn, the predictions on the held out data are returned unscored.
+    """
+    def evaluate():
+        if probs:
+            res = instance.predict_proba(*testXs)
+        else:
+            res = instance.predict(*testXs)
+        return eval_fn(res, testY) if eval_fn is not None else res
+
+    scores = []
+    pruned = False
+
+    def epoch_callback(epoch):
+        nonlocal pruned
+        scores.append(evaluate())
+        pruned = epoch < instance.config.n_epochs and pruner.should_prune(epoch, scores[-1])
+        return pruned
+
+    instance.epoch_callback = epoch_callback if pruner is not None else None
+    instance.finetune(*trainXs, Y=trainY)
+    if not scores:
+        scores.append(evaluate())
+    if pruner is not None and not pruned:
+        pruner.complete(scores)
+    return scores[-1]
+
+
+def _grid_config(config, grid_item):
+    """
+    The full config for one grid search configuration, given the base config and the grid searched values.
+    """
+    return config.with_overrides(**grid_item)
+
+
+def _grid_search_trials(cls, config, grid_items, trainXs, trainY, testXs, testY, eval_fn, probs, pruner=None,
+                        bound=None, share_gpus=False):
+    """
+    Trains and scores grid search configurations that only differ in `_FED_HYPERPARAMETERS` one after another on a
+    single model, so that its graph and session are only built once.  Weights are reset between configurations.
+    Configurations rejected by `bound` are not trained and get a score of -inf.
+    With `share_gpus`, the model's session only takes the GPU memory it needs, leaving room for other workers.
+    """
+    if share_gpus:
+        # only applies to this worker's models, the configs returned by the grid search are built from `config`
+        config = config.with_overrides(gpu_allow_growth=True)
+    # the configs of a worker's group are merged up front, which keeps the training loop free of config handling
+    trial_configs = [_grid_config(config, grid_item) for grid_item in grid_items]
+    instance = cls(config=trial_configs[0])
+    instance.saver.keep_initial_values = True
+    # every configuration trains and predicts on the same text
+    instance.cache_encodings = True
+    scores = []
+    try:
+        for trial_config in trial_configs:
+            if bound is not None and bound.should_skip(trial_config):
+                scores.append(-np.inf)
+                continue
+            if instance.is_trained:
+                instance.saver.reset(instance.sess)
+            instance.config = trial_config
+            scores.append(_grid_search_trial(instance, trainXs, trainY, testXs, testY, eval_fn, probs, pruner))
+            if bound is not None:
+                bound.complete(scores[-1])
+    finally:
+        # free the session's memory now rather than whenever the model happens to be collected
+        instance.close()
+        del instance
+        gc.collect()
+    return scores
+
+
+_GRAPH_TYPES = (
+    tf.Graph, tf.Tensor, tf.Operation, tf.Variable, tf.SparseTensor, tf.IndexedSlices, tf.data.Iterator,
+    tf.summary.FileWriter
+)
+
+
+def _refers_to_graph(value):
+    """
+    Whether :param value: is a graph object, or a list, tuple, set or dict holding one at any depth.
+    """
+    if isinstance(value, _GRAPH_TYPES):
+        return True
+    if isinstance(value, dict):
+        return any(_refers_to_graph(item) for item in itertools.chain(value.keys(), value.values()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return any(_refers_to_graph(item) for item in value)
+    return False
+
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    # The encoder is not modified after construction, so one copy of the vocabulary and BPE merge ranks
+    # can be shared by every model in the process.
+    return TextEncoder()
+
 
 class BaseModel(object, metaclass=ABCMeta):
     """
@@ -46,8 +194,6 @@ class BaseModel(object, metaclass=ABCMeta):
         :param config: A config object generated by `finetune.config.get_config` or None (for default config).
         :param **kwargs: key-value pairs of config items to override.
         """
-        tf.reset_default_graph()
-
         self.config = config or get_default_config()
         self.config.update(kwargs)
 
@@ -61,10 +207,14 @@ class BaseModel(object, metaclass=ABCMeta):
 
     def _initialize(self):
         # Initializes the non-serialized bits of the class.
+        # every model builds into a graph of its own, so models don't interfere with each other or with the default graph
+        self.graph = tf.Graph()
         self._set_random_seed(self.config.seed)
 
         download_data_if_required()
-        self.encoder = TextEncoder()
+        self.encoder = _get_encoder()
+        # ids of the positional embeddings, which are stored after the vocabulary in the embedding matrix
+        self._pos_row = None  # built by `_array_format` for the current `config.max_length`
 
         # symbolic ops
         self.logits = None  # classification logits
@@ -74,19 +224,38 @@ class BaseModel(object, metaclass=ABCMeta):
         self.train = None  # gradient + parameter update
         self.features = None  # hidden representation fed to classifier
         self.summaries = None  # Tensorboard summaries
+        self.grad_summaries = None  # Gradient histograms, only evaluated alongside a training step
         self.train_writer = None
         self.valid_writer = None
         self.predict_params = None
         self.train_op = None
         self.predict_op = None
         self.predict_proba_op = None
+        self.train_iterator = None  # tf.data iterator over the training set
+        self.val_iterator = None  # tf.data iterator over the validation set
+        self.iterator_handle = None  # selects which iterator feeds the graph
+        self.dataset_placeholders = None  # placeholders used to seed the iterators
+        self.batch_size_placeholder = None
+        self.val_loss_sum = None  # validation loss summed over the batches of a validation pass
+        self.val_loss_avg = None  # rolling average of the validation loss over all validation batches
+        self.val_update_op = None
+        self.val_reset_op = None
+        self.val_init_op = None
+        self.lr_placeholder = None
+        self.l2_reg_placeholder = None
+        self.n_updates_placeholder = None
+        self.cache_encodings = False  # reuse the encodings of inputs that have been seen recently
+        self._encoding_cache = OrderedDict()  # hash of the inputs -> encoded inputs, when `cache_encodings` is set
+        self.epoch_callback = None  # called with the number of completed epochs, returns True to stop training
         self.sess = None
-        self.noop = tf.no_op()
+        with self.graph.as_default():
+            self.noop = tf.no_op()
 
         # indicator vars
         self.is_built = False  # has tf graph been constructed?
         self.is_trained = False  # has model been fine-tuned?
         self.require_lm = False
+        self._graph_key = None  # (train, target_dim, require_lm) setting of the currently built graph
 
         def process_embeddings(name, value):
             if "/we:0" not in name:
@@ -109,7 +278,13 @@ class BaseModel(object, metaclass=ABCMeta):
         self.saver = Saver(
             fallback_filename=JL_BASE,
             exclude_matches=None if self.config.save_adam_vars else "adam",
-            variable_transforms=[process_embeddings]
+            variable_transforms=[process_embeddings],
+            # everything `process_embeddings` depends on, so its output on the fallback weights can be cached
+            # read at lookup time, since `config.max_length` can be changed after the model is created
+            transform_key=lambda: (
+                self.encoder.vocab_size, self.config.max_length, self.config.interpolate_pos_embed
+            ),
+            cache_dir=self.config.cache_dir
         )
 
     def _format_for_encoding(self, Xs):
@@ -127,7 +302,21 @@ class BaseModel(object, metaclass=ABCMeta):
     def _text_to_ids(self, Xs, Y=None, max_length=None):
         # Maps lists of text to formatted numpy arrays of token ids and loss-masks marking the lengths of the sequences.
         max_length = max_length or self.config.max_length
+        if not self.cache_encodings:
+            return self._encode_text(Xs, Y=Y, max_length=max_length)
+
+        key = joblib.hash((
+            type(self).__name__, Xs, Y, max_length, self.config.max_length, self.config.chunk_long_sequences
+        ))
+        if key in self._encoding_cache:
+            self._encoding_cache.move_to_end(key)
+        else:
+            self._encoding_cache[key] = self._encode_text(Xs, Y=Y, max_length=max_length)
+            if len(self._encoding_cache) > _ENCODING_CACHE_SIZE:
+                self._encoding_cache.popitem(last=False)
+        return self._encoding_cache[key]
 
+    def _encode_text(self, Xs, Y, max_length):
         # If 1d array of text is passed, coerce into multifield format
         if len(Xs) and isinstance(Xs[0], (bytes, str)):
             Xs = [[x] for x in Xs]
@@ -204,8 +393,12 @@ class BaseModel(object, metaclass=ABCMeta):
     def _training_loop(self, arr_encoded, Y=None, batch_size=None):
         self.label_encoder = self._target_encoder()
 
-        idxs = list(range(len(arr_encoded.token_ids)))
-        train_idxs, val_idxs = train_test_split(idxs, test_size=self.config.val_size)
+        n_total = len(arr_encoded.token_ids)
+        val_size = self.config.val_size
+        n_val = val_size if isinstance(val_size, (int, np.integer)) else int(np.ceil(val_size * n_total))
+        # one seeded shuffle, split into a validation slice and a training slice
+        perm = np.random.RandomState(self.config.seed).permutation(n_total)
+        val_idxs, train_idxs = perm[:n_val], perm[n_val:]
 
         if Y is None:
             # only language model will be trained, mock fake target of right length
@@ -213,9 +406,10 @@ class BaseModel(object, metaclass=ABCMeta):
             val_Y = np.asarray([[]] * len(val_idxs))
             target_dim = None
         else:
-            Y = np.asarray(Y)
-            train_Y = self.label_encoder.fit_transform(Y[train_idxs])
-            val_Y = self.label_encoder.transform(Y[val_idxs])
+            # encode every label in one pass and split the result, rather than encoding each split separately
+            encoded_Y = np.asarray(self.label_encoder.fit_transform(np.asarray(Y)))
+            train_Y = encoded_Y[train_idxs]
+            val_Y = encoded_Y[val_idxs]
             target_dim = self.label_encoder.target_dim
 
         batch_size = batch_size or self.config.batch_size
@@ -226,83 +420,99 @@ class BaseModel(object, metaclass=ABCMeta):
         train_dataset = (arr_encoded.token_ids[train_idxs], arr_encoded.mask[train_idxs], train_Y)
         val_dataset = (arr_encoded.token_ids[val_idxs], arr_encoded.mask[val_idxs], val_Y)
 
-        self._build_model(n_updates_total=n_updates_total, target_dim=target_dim)
+        self._build_model(target_dim=target_dim)
         self.is_trained = True
 
         avg_train_loss = None
         avg_val_loss = None
         global_step = 0
         best_val_loss = float("inf")
-        val_window = [float("inf")] * self.config.val_window_size
+        val_window = deque(maxlen=self.config.val_window_size)
+        val_window_sum = 0.
+
+        n_batches = int(np.ceil(n_examples / n_batch_train))
+        train_feed = dict(zip(self.dataset_placeholders, train_dataset))
+        train_feed[self.batch_size_placeholder] = n_batch_train
+        val_feed = dict(zip(self.dataset_placeholders, val_dataset))
+        val_feed[self.batch_size_placeholder] = n_batch_train
+        val_fetches = [self.val_update_op] + ([self.summaries] if self.valid_writer is not None else [])
+        train_fetches = [self.train_op] + ([self.target_loss] if target_dim is not None else [])
+        summary_fetches = list(train_fetches)
+        if self.train_writer is not None:
+            if self.grad_summaries is not None:
+                summary_fetches.append(self.grad_summaries)
+            summary_fetches.append(self.summaries)
+
+        train_handle, val_handle = self.sess.run(
+            [self.train_iterator.string_handle(), self.val_iterator.string_handle()]
+        )
+        self.sess.run(self.val_init_op)
+        # feeds are bound to the training graph's placeholders up front, so an `epoch_callback` that runs inference
+        # (and so builds the inference graph) does not affect the rest of training
+        train_step_feed = {
+            self.iterator_handle: train_handle,
+            self.do_dropout: DROPOUT_ON,
+            self.lr_placeholder: self.config.lr,
+            self.l2_reg_placeholder: self.config.l2_reg,
+            self.n_updates_placeholder: n_updates_total,
+        }
+        val_step_feed = {self.iterator_handle: val_handle, self.do_dropout: DROPOUT_OFF}
 
         for i in range(self.config.n_epochs):
-            iterator = iter_data(
-                *train_dataset, 
-                n_batch=n_batch_train, 
-                tqdm_desc="Epoch {}".format(i),
-                verbose=self.config.verbose
-            )
-            for (xmb, mmb, ymb) in iterator:
-                feed_dict = {
-                    self.X: xmb,
-                    self.M: mmb,
-                }
-                if target_dim:
-                    feed_dict[self.Y] = ymb
-
+            self.sess.run(self.train_iterator.initializer, feed_dict=train_feed)
+            for _ in tqdm.tqdm(range(n_batches), ncols=80, leave=False, disable=(not self.config.verbose),
+                               desc="Epoch {}".format(i)):
                 global_step += 1
-                if global_step % self.config.val_interval == 0:
-                    feed_dict[self.do_dropout] = DROPOUT_OFF
-
-                    outputs = self._eval(self.summaries, feed_dict=feed_dict)
-                    if self.train_writer is not None:
-                        self.train_writer.add_summary(outputs.get(self.summaries), global_step)
-
-                    sum_val_loss = 0
-                    for xval, mval, yval in iter_data(*val_dataset, n_batch=n_batch_train, verbose=self.config.verbose,
-                                                      tqdm_desc="Validation"):
-                        feed_dict = {
-                            self.X: xval,
-                            self.M: mval,
-                            self.do_dropout: DROPOUT_OFF
-                        }
-                        if target_dim:
-                            feed_dict[self.Y] = yval
-
-                        outputs = self._eval(self.target_loss, self.summaries, feed_dict=feed_dict)
+                do_summary = global_step % self.config.val_interval == 0
+                if do_summary:
+                    self.sess.run([self.val_iterator.initializer, self.val_reset_op], feed_dict=val_feed)
+                    while True:
+                        try:
+                            outputs = self.sess.run(val_fetches, feed_dict=val_step_feed)
+                        except tf.errors.OutOfRangeError:
+                            break
                         if self.valid_writer is not None:
-                            self.valid_writer.add_summary(outputs.get(self.summaries), global_step)
-
-                        val_cost = outputs.get(self.target_loss, 0)
-                        sum_val_loss += val_cost
-
-                        if avg_val_loss is None:
-                            avg_val_loss = val_cost
-                        else:
-                            avg_val_loss = (
-                                    avg_val_loss * self.config.rolling_avg_decay
-                                    + val_cost * (1 - self.config.rolling_avg_decay)
-                            )
-                    val_window.append(sum_val_loss)
-                    val_window.pop(0)
+                            self.valid_writer.add_summary(outputs[-1], global_step)
 
-                    if np.mean(val_window) <= best_val_loss:
-                        best_val_loss = np.mean(val_window)
+                    sum_val_loss, avg_val_loss = self.sess.run([self.val_loss_sum, self.val_loss_avg])
+                    if len(val_window) == val_window.maxlen:
+                        val_window_sum -= val_window[0]
+                    val_window.append(sum_val_loss)
+                    val_window_sum += sum_val_loss
+                    # the window average is undefined (infinite) until the window has filled up
+                    if len(val_window) == val_window.maxlen:
+                        mean_val_loss = val_window_sum / len(val_window)
+                    else:
+                        mean_val_loss = float("inf")
+
+                    if mean_val_loss <= best_val_loss and (
+                            best_val_loss == float("inf") or
+                            best_val_loss - mean_val_loss >= self.config.autosave_min_delta
+                    ):
+                        best_val_loss = mean_val_loss
                         if self.config.autosave_path is not None:
                             self.save(self.config.autosave_path)
 
                     tqdm.tqdm.write("Train loss: {}\t Validation loss: {}".format(avg_train_loss, avg_val_loss))
 
-                feed_dict[self.do_dropout] = DROPOUT_ON
-                outputs = self._eval(self.target_loss, self.train_op, feed_dict=feed_dict)
+                # the training batch comes from `self.train_iterator`, so train summaries are
+                # evaluated in the same step as the update rather than in a separate call
+                outputs = self.sess.run(summary_fetches if do_summary else train_fetches, feed_dict=train_step_feed)
+                if do_summary and self.train_writer is not None:
+                    for summary in outputs[len(train_fetches):]:
+                        self.train_writer.add_summary(summary, global_step)
 
-                cost = outputs.get(self.target_loss, 0)
+                cost = outputs[1] if target_dim is not None else 0
                 if avg_train_loss is None:
                     avg_train_loss = cost
                 else:
                     avg_train_loss = avg_train_loss * self.config.rolling_avg_decay + cost * (
                             1 - self.config.rolling_avg_decay)
 
+            if self.epoch_callback is not None and self.epoch_callback(i + 1):
+                # the callback has asked for training to stop early
+                break
+
         return self
 
     def fit(self, *args, **kwargs):
@@ -314,14 +524,11 @@ class BaseModel(object, metaclass=ABCMeta):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
             max_length = max_length or self.config.max_length
-            for xmb, mmb in self._infer_prep(Xs, max_length=max_length):
-                output = self._eval(self.predict_op,
-                    feed_dict={
-                        self.X: xmb,
-                        self.M: mmb,
-                        self.do_dropout: DROPOUT_OFF
-                    }
-                )
+            batches = self._infer_prep(Xs, max_length=max_length)
+            feed_dict = {self.do_dropout: DROPOUT_OFF}
+            for xmb, mmb in batches:
+                feed_dict[self.X], feed_dict[self.M] = xmb, mmb
+                output = self._eval(self.predict_op, feed_dict=feed_dict)
                 prediction = output.get(self.predict_op)
                 formatted_predictions = self.label_encoder.inverse_transform(prediction)
                 predictions.append(formatted_predictions)
@@ -338,15 +545,11 @@ class BaseModel(object, metaclass=ABCMeta):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
             max_length = max_length or self.config.max_length
-            for xmb, mmb in self._infer_prep(Xs, max_length=max_length):
-                output = self._eval(
-                    self.predict_proba_op,
-                    feed_dict={
-                        self.X: xmb,
-                        self.M: mmb,
-                        self.do_dropout: DROPOUT_OFF
-                    }
-                )
+            batches = self._infer_prep(Xs, max_length=max_length)
+            feed_dict = {self.do_dropout: DROPOUT_OFF}
+            for xmb, mmb in batches:
+                feed_dict[self.X], feed_dict[self.M] = xmb, mmb
+                output = self._eval(self.predict_proba_op, feed_dict=feed_dict)
                 probas = output.get(self.predict_proba_op)
                 predictions.extend(probas)
         return predictions
@@ -370,12 +573,11 @@ class BaseModel(object, metaclass=ABCMeta):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
             max_length = max_length or self.config.max_length
-            for xmb, mmb in self._infer_prep(Xs, max_length=max_length):
-                feature_batch = self.sess.run(self.features, {
-                    self.X: xmb,
-                    self.M: mmb,
-                    self.do_dropout: DROPOUT_OFF
-                })
+            batches = self._infer_prep(Xs, max_length=max_length)
+            feed_dict = {self.do_dropout: DROPOUT_OFF}
+            for xmb, mmb in batches:
+                feed_dict[self.X], feed_dict[self.M] = xmb, mmb
+                feature_batch = self.sess.run(self.features, feed_dict)
                 features.append(feature_batch)
         return np.concatenate(features)
 
@@ -391,6 +593,15 @@ class BaseModel(object, metaclass=ABCMeta):
     def get_eval_fn(cls):
         raise NotImplementedError("No default eval function is given, please pass an explicit eval fn to grid_search")
 
+    @classmethod
+    def get_batch_eval_fn(cls):
+        """
+        Optionally, a vectorized version of the default eval function, used by grid search to score the predictions of
+        all configurations at once.  It takes a list of predictions per configuration and the targets, and returns an
+        array of scores.
+        """
+        return None
+
     def transform(self, *args, **kwargs):
         """
         An alias for `featurize`.
@@ -401,9 +612,9 @@ class BaseModel(object, metaclass=ABCMeta):
         max_length = max_length or self.config.max_length
         arr_encoded = self._text_to_ids(Xs, max_length=max_length)
         n_batch_train = self.config.batch_size * max(len(self.config.visible_gpus), 1)
-        self._build_model(n_updates_total=0, target_dim=self.target_dim, train=False)
-        yield from iter_data(arr_encoded.token_ids, arr_encoded.mask, n_batch=n_batch_train,
-                             verbose=self.config.verbose)
+        # the model is built before returning, so callers can refer to its placeholders
+        self._build_model(target_dim=self.target_dim, train=False)
+        return iter_data(arr_encoded.token_ids, arr_encoded.mask, n_batch=n_batch_train, verbose=self.config.verbose)
 
     def _array_format(self, encoded_output):
         """
@@ -413,20 +624,38 @@ class BaseModel(object, metaclass=ABCMeta):
             1: positional embedding
         """
         n = len(encoded_output.token_ids)
-        seq_lengths = [len(x) for x in encoded_output.token_ids]
-        x = np.zeros((n, self.config.max_length, 2), dtype=np.int32)
-        mask = np.zeros((n, self.config.max_length), dtype=np.float32)
-        labels_arr = np.full((n, self.config.max_length), PAD_TOKEN,
+        max_length = self.config.max_length
+        seq_lengths = np.fromiter((len(x) for x in encoded_output.token_ids), dtype=np.int64, count=n)
+        n_tokens = int(seq_lengths.sum())
+        # the numba kernel does not bounds check, so overlong sequences have to be rejected before filling
+        if n and seq_lengths.max() > max_length:
+            raise ValueError(
+                "Encoded sequence of length {} does not fit in max_length={}".format(seq_lengths.max(), max_length)
+            )
+
+        offsets = np.cumsum(seq_lengths) - seq_lengths
+        flat_tokens = np.fromiter(
+            itertools.chain.from_iterable(encoded_output.token_ids), dtype=np.int32, count=n_tokens
+        )
+
+        # BPE embedding, and masking: value of 1 means "consider this in cross-entropy LM loss"
+        x = np.zeros((n, max_length, 2), dtype=np.int32)
+        mask = np.zeros((n, max_length), dtype=np.float32)
+        fill = fill_token_array if fill_token_array is not None else fill_token_array_numpy
+        fill(x, mask, flat_tokens, offsets, seq_lengths)
+
+        labels_arr = np.full((n, max_length), PAD_TOKEN,
                              dtype='object') if encoded_output.labels is not None else None
-        for i, seq_length in enumerate(seq_lengths):
-            # BPE embedding
-            x[i, :seq_length, 0] = encoded_output.token_ids[i]
-            # masking: value of 1 means "consider this in cross-entropy LM loss"
-            mask[i, 1:seq_length] = 1
-            if encoded_output.labels:
-                labels_arr[i, :seq_length] = encoded_output.labels[i]
+        if encoded_output.labels:
+            # labels can be of mixed type, so avoid letting numpy coerce them to a common dtype
+            flat_labels = np.empty(n_tokens, dtype='object')
+            flat_labels[:] = list(itertools.chain.from_iterable(encoded_output.labels))
+            labels_arr[ragged_coords(seq_lengths, offsets)] = flat_labels
         # positional_embeddings
-        x[:, :, 1] = np.arange(self.encoder.vocab_size, self.encoder.vocab_size + self.config.max_length)
+        if self._pos_row is None or len(self._pos_row) != max_length:
+            # `config.max_length` can be changed after the model is created
+            self._pos_row = np.arange(self.encoder.vocab_size, self.encoder.vocab_size + max_length, dtype=np.int32)
+        x[:, :, 1] = self._pos_row
 
         return ArrayEncodedOutput(
             token_ids=x,
@@ -436,36 +665,60 @@ class BaseModel(object, metaclass=ABCMeta):
             mask=mask,
         )
 
-    def _compile_train_op(self, *, params, grads, n_updates_total):
-        grads = average_grads(grads)
+    def _compile_train_op(self, *, params, grads):
+        if self.config.nccl_all_reduce and len(self.config.visible_gpus) > 1:
+            grads = all_reduce_grads(grads)
+        else:
+            grads = average_grads(grads)
 
         if self.config.summarize_grads:
-            self.summaries += tf.contrib.training.add_gradients_summaries(grads)
+            # kept out of `self.summaries` so that validation never has to compute gradients
+            self.grad_summaries = tf.summary.merge(tf.contrib.training.add_gradients_summaries(grads))
+
+        # hyperparameters that are fed at train time, so that the same graph can be trained again with new values
+        self.lr_placeholder = tf.placeholder(tf.float32, [], name='lr')
+        self.l2_reg_placeholder = tf.placeholder(tf.float32, [], name='l2_reg')
+        self.n_updates_placeholder = tf.placeholder(tf.float32, [], name='n_updates_total')
 
         grads = [grad for grad, param in grads]
-        self.train_op = AdamWeightDecay(
-            params=params,
-            grads=grads,
-            lr=self.config.lr,
-            schedule=partial(schedules[self.config.lr_schedule], warmup=self.config.lr_warmup),
-            t_total=n_updates_total,
-            l2=self.config.l2_reg,
-            max_grad_norm=self.config.max_grad_norm,
-            vector_l2=self.config.vector_l2,
-            b1=self.config.b1,
-            b2=self.config.b2,
-            e=self.config.epsilon,
-            pretrained_weights=self.saver.get_pretrained_weights(),
-            deviation_regularization=self.config.regularize_deviation
-        )
+        # the optimizer update is a long chain of small elementwise ops per variable, which XLA fuses
+        with self._jit_scope():
+            self.train_op = AdamWeightDecay(
+                params=params,
+                grads=grads,
+                lr=self.lr_placeholder,
+                schedule=partial(schedules[self.config.lr_schedule], warmup=self.config.lr_warmup),
+                t_total=self.n_updates_placeholder,
+                l2=self.l2_reg_placeholder,
+                max_grad_norm=self.config.max_grad_norm,
+                vector_l2=self.config.vector_l2,
+                b1=self.config.b1,
+                b2=self.config.b2,
+                e=self.config.epsilon,
+                pretrained_weights=self.saver.get_pretrained_weights(),
+                deviation_regularization=self.config.regularize_deviation,
+                loss_scale=self.config.fp16_loss_scale if self.config.use_fp16 else 1.
+            )
 
-    def _construct_graph(self, n_updates_total, target_dim=None, train=True):
+    def _jit_scope(self):
+        # marks the ops created inside for XLA compilation, so that they can be fused into fewer kernels
+        # gradients of these ops are marked as well
+        if self.config.xla_jit:
+            # imported here so that tf.contrib is only loaded when XLA is used
+            from tensorflow.contrib.compiler import jit
+            return jit.experimental_jit_scope()
+        return contextlib.ExitStack()
+
+    def _construct_graph(self, target_dim=None, train=True):
         gpu_grads = []
         self.summaries = []
+        self.grad_summaries = None
 
         # store whether or not graph was previously compiled with dropout
         self.train = train
         self._define_placeholders(target_dim=target_dim)
+        if train:
+            self._define_dataset(target_dim=target_dim)
 
         aggregator = defaultdict(list)
         train_loss_tower = 0
@@ -482,49 +735,55 @@ class BaseModel(object, metaclass=ABCMeta):
         lm_loss_coef = self.config.lm_loss_coef
         if target_dim is None:
             lm_loss_coef = 1.0
-        compile_lm = (train and lm_loss_coef > 0) or self.require_lm
-
-        for i, (X, M, Y) in enumerate(soft_split(self.X, self.M, self.Y, n_splits=n_splits)):
-            do_reuse = True if i > 0 else tf.AUTO_REUSE
+        compile_lm_train = train and lm_loss_coef > 0
+        # the sampling op is only needed by `generate_text`, which sets `require_lm`
+        compile_lm_sample = self.require_lm
+        compile_lm = compile_lm_train or compile_lm_sample
 
+        def tower_device(i):
             if gpus:
-                device = tf.device(assign_to_gpu(gpus[i], params_device=params_device))
-            else:
-                device = tf.device('cpu')
+                return tf.device(assign_to_gpu(gpus[i], params_device=params_device))
+            return tf.device('cpu')
 
+        tower_losses = []
+        for i, (X, M, Y) in enumerate(soft_split(self.X, self.M, self.Y, n_splits=n_splits)):
+            do_reuse = True if i > 0 else tf.AUTO_REUSE
             scope = tf.variable_scope(tf.get_variable_scope(), reuse=do_reuse)
 
-            with device, scope:
-                featurizer_state = featurizer(
-                    X,
-                    config=self.config,
-                    encoder=self.encoder,
-                    dropout_placeholder=self.do_dropout,
-                    train=train,
-                    reuse=do_reuse
-                )
-
-                if compile_lm:
-                    language_model_state = language_model(
-                        X=X,
-                        M=M,
+            with tower_device(i), scope:
+                with self._jit_scope():
+                    featurizer_state = featurizer(
+                        X,
                         config=self.config,
-                        embed_weights=featurizer_state['embed_weights'],
-                        hidden=featurizer_state['sequence_features'],
+                        encoder=self.encoder,
+                        dropout_placeholder=self.do_dropout,
+                        train=train,
                         reuse=do_reuse
                     )
 
+                if compile_lm:
+                    with self._jit_scope():
+                        language_model_state = language_model(
+                            X=X,
+                            M=M,
+                            config=self.config,
+                            embed_weights=featurizer_state['embed_weights'],
+                            hidden=featurizer_state['sequence_features'],
+                            reuse=do_reuse
+                        )
+
                     train_loss = lm_loss_coef * tf.reduce_mean(language_model_state['losses'])
                     aggregator['lm_losses'].append(language_model_state['losses'])
-                    lm_logits = language_model_state["logits"]
-                    aggregator["lm_model"].append(sample_with_temperature(lm_logits, self.config.lm_temp))
+                    if compile_lm_sample:
+                        lm_logits = language_model_state["logits"]
+                        aggregator["lm_model"].append(sample_with_temperature(lm_logits, self.config.lm_temp))
                 else:
                     train_loss = 0
 
                 aggregator['features'].append(featurizer_state['features'])
 
                 if target_dim is not None:
-                    with tf.variable_scope('model/target'):
+                    with tf.variable_scope('model/target'), self._jit_scope():
                         target_model_state = self._target_model(
                             featurizer_state=featurizer_state,
                             targets=Y,
@@ -539,16 +798,27 @@ class BaseModel(object, metaclass=ABCMeta):
                     aggregator['logits'].append(target_model_state['logits'])
                     aggregator['target_losses'].append(target_model_state['losses'])
 
-                params = find_trainable_variables("model")
-                grads = tf.gradients(train_loss, params)
-                grads = list(zip(grads, params))
-                gpu_grads.append(grads)
+                tower_losses.append(train_loss)
+
+        if train:
+            # every tower shares the same variables, so they only need to be looked up once
+            params = find_trainable_variables("model")
+            for i, train_loss in enumerate(tower_losses):
+                with tower_device(i):
+                    if self.config.use_fp16:
+                        train_loss *= self.config.fp16_loss_scale
+                    grads = tf.gradients(train_loss, params)
+                    gpu_grads.append(list(zip(grads, params)))
+            # layers frozen through `num_layers_trained` / `train_embeddings` receive no gradient, leave them out
+            trained = [grad is not None for grad, _ in gpu_grads[0]]
+            params = list(itertools.compress(params, trained))
+            gpu_grads = [list(itertools.compress(tower_grads, trained)) for tower_grads in gpu_grads]
 
         with tf.device(params_device):
             self.features = tf.concat(aggregator['features'], axis=0)
 
+            self.lm_predict_op = tf.concat(aggregator["lm_model"], 0) if compile_lm_sample else None
             if compile_lm:
-                self.lm_predict_op = tf.concat(aggregator["lm_model"], 0)
                 self.lm_losses = tf.concat(aggregator['lm_losses'], axis=0)
                 self.lm_loss = tf.reduce_mean(self.lm_losses)
                 self.summaries.append(tf.summary.scalar('LanguageModelLoss', self.lm_loss))
@@ -556,8 +826,7 @@ class BaseModel(object, metaclass=ABCMeta):
             if train:
                 self._compile_train_op(
                     params=params,
-                    grads=gpu_grads,
-                    n_updates_total=n_updates_total
+                    grads=gpu_grads
                 )
 
             if target_dim is not None:
@@ -577,17 +846,26 @@ class BaseModel(object, metaclass=ABCMeta):
 
             self.summaries = tf.summary.merge(self.summaries) if self.summaries else self.noop
 
-    def _build_model(self, n_updates_total, target_dim, train=True):
+            if train:
+                self._define_validation_ops(self.target_loss if target_dim is not None else tf.constant(0.))
+
+    def _build_model(self, target_dim, train=True):
         """
         Construct tensorflow symbolic graph.
+        The graph is only reconstructed (and its weights reloaded) when the requested configuration differs from the
+        one that is currently built, so repeated inference calls reuse the existing graph and session.
+        A training graph also serves inference, since dropout is switched off through `self.do_dropout`.
         """
-        if not self.is_trained or train != self.train or self.target_dim != target_dim:
+        graph_key = (train, target_dim, self.require_lm)
+        reuse_train_graph = not train and self._graph_key == (True, target_dim, self.require_lm)
+        if not self.is_built or (graph_key != self._graph_key and not reuse_train_graph):
             # reconstruct graph to include/remove dropout
             # if `train` setting has changed
-            self._construct_graph(n_updates_total, target_dim, train=train)
-
-        self._initialize_session()
-        self.saver.initialize(self.sess)
+            with self.graph.as_default():
+                self._construct_graph(target_dim, train=train)
+                self._initialize_session()
+                self.saver.initialize(self.sess)
+            self._graph_key = graph_key
 
         self.target_dim = target_dim
         if train:
@@ -604,13 +882,17 @@ class BaseModel(object, metaclass=ABCMeta):
             os.environ['CUDA_VISIBLE_DEVICES'] = ",".join([str(gpu) for gpu in gpus])
             conf = tf.ConfigProto(allow_soft_placement=self.config.soft_device_placement,
                                   log_device_placement=self.config.log_device_placement)
-            self.sess = tf.Session(config=conf)
+            if self.config.xla_jit:
+                conf.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+            conf.gpu_options.allow_growth = self.config.gpu_allow_growth
+            self.sess = tf.Session(graph=self.graph, config=conf)
 
     def _set_random_seed(self, seed=None):
         seed = seed or self.config.seed
         random.seed(seed)
         np.random.seed(seed)
-        tf.set_random_seed(seed)
+        with self.graph.as_default():
+            tf.set_random_seed(seed)
 
     def _target_placeholder(self, target_dim=None):
         return tf.placeholder(tf.float32, [None, target_dim or 1])  # classification targets
@@ -624,6 +906,63 @@ class BaseModel(object, metaclass=ABCMeta):
         self.do_dropout = tf.placeholder(tf.float32)  # 1 for do dropout and 0 to not do dropout
         self.Y = self._target_placeholder(target_dim=target_dim)
 
+    def _define_dataset(self, target_dim=None):
+        """
+        Streams training and validation batches into the graph through `tf.data` pipelines instead of a per-step
+        `feed_dict`.
+
+        Both pipelines are seeded from the placeholders created by `_define_placeholders`, and the batch produced by
+        whichever iterator `self.iterator_handle` selects takes their place as `self.X`, `self.M` and `self.Y`.
+        These outputs remain feedable, so batches can still be passed in directly.
+        """
+        placeholders = [self.X, self.M] if target_dim is None else [self.X, self.M, self.Y]
+        self.dataset_placeholders = placeholders
+        self.batch_size_placeholder = tf.placeholder(tf.int64, [])
+
+        dataset = tf.data.Dataset.from_tensor_slices(tuple(placeholders))
+        dataset = dataset.batch(self.batch_size_placeholder).prefetch(1)
+        self.train_iterator = dataset.make_initializable_iterator()
+        self.val_iterator = dataset.make_initializable_iterator()
+
+        self.iterator_handle = tf.placeholder(tf.string, [])
+        iterator = tf.data.Iterator.from_string_handle(
+            self.iterator_handle, dataset.output_types, dataset.output_shapes
+        )
+
+        batch = [
+            tf.placeholder_with_default(tensor, placeholder.get_shape())
+            for tensor, placeholder in zip(iterator.get_next(), placeholders)
+        ]
+        self.X, self.M = batch[:2]
+        if target_dim is not None:
+            self.Y = batch[2]
+
+    def _define_validation_ops(self, target_loss):
+        """
+        Accumulates the validation loss inside the graph, so a validation pass only runs `val_update_op` once per
+        batch and reads back `val_loss_sum` and `val_loss_avg` at the end.
+        """
+        decay = self.config.rolling_avg_decay
+        local_variable = partial(
+            tf.get_variable, shape=[], trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES]
+        )
+        with tf.variable_scope('validation', reuse=tf.AUTO_REUSE):
+            loss_sum = local_variable('loss_sum', dtype=tf.float32, initializer=tf.zeros_initializer())
+            loss_avg = local_variable('loss_avg', dtype=tf.float32, initializer=tf.zeros_initializer())
+            n_batches = local_variable('n_batches', dtype=tf.int32, initializer=tf.zeros_initializer())
+
+            new_sum = loss_sum + target_loss
+            new_avg = tf.where(n_batches > 0, loss_avg * decay + target_loss * (1 - decay), target_loss)
+            with tf.control_dependencies([new_sum, new_avg]):
+                self.val_update_op = tf.group(
+                    loss_sum.assign(new_sum), loss_avg.assign(new_avg), n_batches.assign_add(1)
+                )
+
+        self.val_loss_sum = loss_sum
+        self.val_loss_avg = loss_avg
+        self.val_reset_op = loss_sum.assign(0.)
+        self.val_init_op = tf.variables_initializer([loss_sum, loss_avg, n_batches])
+
     def generate_text(self, seed_text='', max_length=None):
         """
         Performs a prediction on the Language modeling objective given some seed text. It uses a noisy greedy decoding.
@@ -635,17 +974,25 @@ class BaseModel(object, metaclass=ABCMeta):
         """
         self.require_lm = True
         encoded = self.encoder._encode([seed_text])
-        self._build_model(n_updates_total=0, target_dim=self.target_dim, train=False)
+        # no-op unless the current graph was built without the language model
+        self._build_model(target_dim=self.target_dim, train=False)
         string = [self.encoder['_start_']] + encoded.token_ids[0]
         EOS = self.encoder['_classify_']
+        max_length = min(max_length or self.config.max_length, self.config.max_length)
+
+        # format the seed once, then write each generated token into the next free cell
+        arr_encoded = self._array_format(EncodedOutput(token_ids=[string]))
+        token_ids, mask = arr_encoded.token_ids, arr_encoded.mask
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
-            for i in range(len(encoded.token_ids), (max_length or self.config.max_length) - 1):
-                arr_encoded = self._array_format(encoded)
-                class_idx = self.sess.run(self.lm_predict_op, {self.X: arr_encoded.token_ids, self.M: arr_encoded.mask})
-                string.append(class_idx[i])
+            for i in range(len(string), max_length):
+                class_idx = self.sess.run(self.lm_predict_op, {self.X: token_ids, self.M: mask})
+                # the prediction made from position i - 1 is the token at position i
+                string.append(class_idx[i - 1])
                 if string[-1] == EOS:
                     break
+                token_ids[0, i, 0] = string[-1]
+                mask[0, i] = 1
         return self.encoder.decode(string)
 
     def __getstate__(self):
@@ -665,9 +1012,10 @@ class BaseModel(object, metaclass=ABCMeta):
         """
         Saves the state of the model to disk to the folder specific by `path`.  If `path` does not exist, it will be auto-created.
 
-        Save is performed in two steps:
-            - Serialize tf graph to disk using tf.Saver
-            - Serialize python model using pickle
+        The model is written as a single numpy archive containing:
+            - The values of all variables that differ from the pre-trained weights
+            - JSON metadata holding the config and target information
+            - The pickled label encoder
 
         Note:
             Does not serialize state of Adam optimizer.
@@ -677,25 +1025,27 @@ class BaseModel(object, metaclass=ABCMeta):
             return
 
         path = os.path.abspath(path)
-        self.saver.save(self, path)
+        with self.graph.as_default():
+            self.saver.save(self, path)
         self._load_from_file = False
 
     @classmethod
     def load(cls, path):
         """
-        Load a saved fine-tuned model from disk.  Path provided should be a folder which contains .pkl and tf.Saver() files
+        Load a saved fine-tuned model from disk.  Path provided should be a file written by :meth:`save`.
 
-        :param path: string path name to load model from.  Same value as previously provided to :meth:`save`. Must be a folder.
+        :param path: string path name to load model from.  Same value as previously provided to :meth:`save`.
         """
         saver = Saver(JL_BASE)
-        model = saver.load(path)
+        model = cls.__new__(cls)
+        model.__dict__.update(saver.load(path))
         model._initialize()
         model.saver.variables = saver.variables
-        tf.reset_default_graph()
         return model
    
     @classmethod
-    def finetune_grid_search(cls, Xs, Y, *, test_size, config=None, eval_fn=None, probs=False, return_all=False):
+    def finetune_grid_search(cls, Xs, Y, *, test_size, config=None, eval_fn=None, probs=False, return_all=False,
+                             n_jobs=1, prune=False, search_strategy="grid", n_trials=None, score_upper_bound=None):
         """
         Performs grid search over config items defined using "GridSearchable" objects and returns either full results or
         the config object that relates to the best results. The default config contains grid searchable objects for the
@@ -709,6 +1059,22 @@ class BaseModel(object, metaclass=ABCMeta):
         :param eval_fn: An eval function that takes 2 inputs (prediction, truth) and returns a float, with a max value being desired.
         :param probs: If true, eval_fn is passed probability outputs from predict_proba, otherwise the output of predict is used.
         :param return_all: If True, all results are returned, if False, only the best config is returned.
+        :param n_jobs: Number of configurations to train in parallel, each worker process with its own graph and
+            session.  Defaults to 1, which trains every configuration in the calling process.  Configurations that only
+            differ in `lr`, `l2_reg` or `n_epochs` reuse a worker's graph and session rather than building new ones.
+            With more than one worker, sessions grow their GPU memory as needed (`gpu_allow_growth`) so that workers
+            can share the visible GPUs, which then have to fit every concurrently trained model.
+        :param prune: If True, each configuration is evaluated after every epoch and stopped early if it scores below the
+            median of previously completed configurations at the same epoch.  Stopped configurations are reported with
+            their score at the point they were stopped.  Only configurations trained by the same worker are compared,
+            so this is most effective with `n_jobs=1`.
+        :param search_strategy: "grid" to try every combination of grid searchable values, or "random" to try
+            `n_trials` combinations drawn at random without replacement (seeded by `config.seed`).  Defaults to "grid".
+        :param n_trials: Number of combinations tried by random search.  Defaults to all of them.
+        :param score_upper_bound: A function that takes a config and returns the highest score `eval_fn` could give it,
+            e.g. `lambda config: 1.0` for accuracy.  Configurations whose bound does not exceed the best score seen so
+            far are not trained and are reported with a score of -inf.  As with `prune`, only scores seen by the same
+            worker are taken into account.  Defaults to None, which trains every configuration.
         :return: default is to return the best config object. If return_all is true, it returns a list of tuples of the
             form [(config, eval_fn output), ... ]
 
@@ -717,35 +1083,77 @@ class BaseModel(object, metaclass=ABCMeta):
             Xs = [Xs]
         config = config or get_default_config()
         config.val_size = 0.0
-        eval_fn = eval_fn or cls.get_eval_fn()
-
-        trainXs, testXs, trainY, testY = train_test_split(list_transpose(Xs), Y, test_size=test_size, shuffle=True)
-        trainXs = list_transpose(trainXs)
-        testXs = list_transpose(testXs)
+        # the default metric scores the predictions of every configuration in one go once training is done
+        batch_eval_fn = (
+            cls.get_batch_eval_fn() if eval_fn is None and not probs and not prune and score_upper_bound is None
+            else None
+        )
+        if batch_eval_fn is None:
+            eval_fn = eval_fn or cls.get_eval_fn()
+
+        # split by index so that each input column is sliced directly, without transposing the inputs into rows
+        Xs = [list(column) for column in Xs]
+        Y = list(Y)
+        train_idxs, test_idxs = next(ShuffleSplit(n_splits=1, test_size=test_size).split(Y))
+        trainXs = [[column[i] for i in train_idxs] for column in Xs]
+        testXs = [[column[i] for i in test_idxs] for column in Xs]
+        trainY = [Y[i] for i in train_idxs]
+        testY = [Y[i] for i in test_idxs]
         gs = config.get_grid_searchable()
-        ranged_keys = gs.keys()
-        ranged_iterators = gs.values()
-        grid_gen = itertools.product(*ranged_iterators)
-        results = []
-        for grid_item in grid_gen:
-            config_ = deepcopy(config)
-            config_.update(dict(zip(ranged_keys, grid_item)))
-            instance = cls(config=config_)
-            instance.finetune(*trainXs, Y=trainY)
-            if probs:
-                res = instance.predict_proba(*testXs)
-            else:
-                res = instance.predict(*testXs)
-            results.append((config_, eval_fn(res, testY)))
-            del instance
+        ranged_keys = list(gs.keys())
+        ranged_iterators = [list(iterator) for iterator in gs.values()]
+        if search_strategy == "grid":
+            grid_gen = itertools.product(*ranged_iterators)
+        elif search_strategy == "random":
+            # draw positions in the full grid rather than materializing it
+            sizes = [len(iterator) for iterator in ranged_iterators]
+            n_grid = int(np.prod(sizes))
+            grid_idxs = random.Random(config.seed).sample(range(n_grid), min(n_trials or n_grid, n_grid))
+            grid_gen = (
+                tuple(iterator[i] for iterator, i in zip(ranged_iterators, np.unravel_index(grid_idx, sizes)))
+                for grid_idx in grid_idxs
+            )
+        else:
+            raise ValueError("search_strategy must be one of 'grid' or 'random', got {}".format(search_strategy))
+        # only the grid searched values of each configuration are kept, full configs are built as they are needed
+        grid_items = [dict(zip(ranged_keys, grid_item)) for grid_item in grid_gen]
+
+        # configurations that only differ in fed hyperparameters are trained on a shared model, with each such group
+        # split over at most n_jobs workers
+        groups = defaultdict(list)
+        for i, grid_item in enumerate(grid_items):
+            groups[repr([grid_item[key] for key in ranged_keys if key not in _FED_HYPERPARAMETERS])].append(i)
+        n_workers = joblib.effective_n_jobs(n_jobs)
+        tasks = [idxs[w::n_workers] for idxs in groups.values() for w in range(min(n_workers, len(idxs)))]
+
+        pruner = _MedianPruner() if prune else None
+        bound = _ScoreBound(score_upper_bound) if score_upper_bound is not None else None
+        task_scores = joblib.Parallel(n_jobs=n_jobs, backend="loky")(
+            joblib.delayed(_grid_search_trials)(
+                cls, config, [grid_items[i] for i in task], trainXs, trainY, testXs, testY, eval_fn, probs, pruner,
+                bound, share_gpus=n_workers > 1
+            )
+            for task in tasks
+        )
+        if batch_eval_fn is not None:
+            predictions = [None] * len(grid_items)
+            for task, task_predictions in zip(tasks, task_scores):
+                for i, prediction in zip(task, task_predictions):
+                    predictions[i] = prediction
+            scores = np.asarray(batch_eval_fn(predictions, testY), dtype=np.float64)
+        else:
+            scores = np.empty(len(grid_items), dtype=np.float64)
+            for task, task_score in zip(tasks, task_scores):
+                scores[task] = task_score
 
         if return_all:
-            return results
-        return max(results, key=lambda x: x[1])[0]
+            return [(_grid_config(config, grid_item), score) for grid_item, score in zip(grid_items, scores.tolist())]
+        return _grid_config(config, grid_items[int(np.argmax(scores))])
 
 
     @classmethod
-    def finetune_grid_search_cv(cls, Xs, Y, *, n_splits, test_size, config=None, eval_fn=None, probs=False, return_all=False):
+    def finetune_grid_search_cv(cls, Xs, Y, *, n_splits, test_size, config=None, eval_fn=None, probs=False, return_all=False,
+                                n_jobs=1, prune=False, search_strategy="grid", n_trials=None, score_upper_bound=None):
         """
         Performs cross validated grid search over config items defined using "GridSearchable" objects and returns either full results or
         the config object that relates to the best results. The default config contains grid searchable objects for the
@@ -763,13 +1171,22 @@ class BaseModel(object, metaclass=ABCMeta):
             desired. An arithmetic mean must make sense for this metric.
         :param probs: If true, eval_fn is passed probability outputs from predict_proba, otherwise the output of predict is used.
         :param return_all: If True, all results are returned, if False, only the best config is returned.
+        :param n_jobs: Number of configurations to train in parallel within each split.  Defaults to 1.
+        :param prune: Stop configurations early within each split, see :meth:`finetune_grid_search`.  Defaults to False.
+        :param search_strategy: "grid" or "random", see :meth:`finetune_grid_search`.  The same combinations are tried
+            in every split.  Defaults to "grid".
+        :param n_trials: Number of combinations tried by random search.  Defaults to all of them.
+        :param score_upper_bound: Skip configurations that cannot beat the best score within each split, see
+            :meth:`finetune_grid_search`.  Defaults to None.
         :return: default is to return the best config object. If return_all is true, it returns a list of tuples of the
             form [(config, eval_fn output), ... ]
         """
         results = []
         for _ in range(n_splits):
             res = cls.finetune_grid_search(Xs, Y, test_size=test_size, probs=probs, eval_fn=eval_fn, config=config,
-                                           return_all=True)
+                                           return_all=True, n_jobs=n_jobs, prune=prune,
+                                           search_strategy=search_strategy, n_trials=n_trials,
+                                           score_upper_bound=score_upper_bound)
             results.append(res)
         results = list(zip(*results))
         aggregated_results = []
@@ -789,6 +1206,30 @@ class BaseModel(object, metaclass=ABCMeta):
 
         return max(aggregated_results, key=lambda x: x[1])[0]
 
+    def close(self):
+        """
+        Closes the model's session and drops its graph, releasing the memory held by the model's variables
+        immediately instead of when the model is garbage collected.  The model cannot be used once it is closed.
+        """
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+        for writer in (self.train_writer, self.valid_writer):
+            if writer is not None:
+                writer.close()
+
+        self.saver.release()
+        self._encoding_cache.clear()
+        # anything left referring to the graph would keep it alive, including containers of graph objects such as
+        # `dataset_placeholders` or `predict_params`
+        for name, value in list(self.__dict__.items()):
+            if _refers_to_graph(value):
+                setattr(self, name, None)
+        self.epoch_callback = None
+        self.graph = None
+        self.is_built = False
+        self._graph_key = None
+
     def __del__(self):
         try:
             if self.sess is not None:
@@ -56,9 +56,14 @@ class Classifier(BaseModel):
         """
         return super().finetune(X, Y=Y, batch_size=batch_size)
 
+    @classmethod
     def get_eval_fn(cls):
         return lambda labels, targets: np.mean(np.asarray(labels) == np.asarray(targets))
 
+    @classmethod
+    def get_batch_eval_fn(cls):
+        return lambda labels, targets: np.mean(np.asarray(labels) == np.asarray(targets)[None], axis=1)
+
     def _target_encoder(self):
         return OneHotLabelEncoder()
 
@@ -1,3 +1,5 @@
+import os
+
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 from functools import lru_cache
@@ -5,6 +7,7 @@ from collections import namedtuple
 
 # CONSTANTS
 PAD_TOKEN = '<PAD>'
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "finetune")
 
 
 @lru_cache()
@@ -68,17 +71,43 @@ class Settings(dict):
     :param multi_label_threshold: Threshold of sigmoid unit in multi label classifier. 
         Can be increased or lowered to trade off precision / recall. Defaults to `0.5`.
     :param autosave_path: Save current best model (as measured by validation loss) to this location. Defaults to `None`.
+    :param autosave_min_delta: Minimum decrease in the windowed validation loss before the model is autosaved again, to
+        avoid rewriting the checkpoint for insignificant improvements.  Defaults to `0.0`.
     :param tensorboard_folder: Directory for tensorboard logs. Tensorboard logs will not be written 
         unless tensorboard_folder is explicitly provided. Defaults to `None`.
     :param log_device_placement: Log which device each operation is placed on for debugging purposes.  Defaults to `False`.
+    :param xla_jit: Compile the featurizer, language model, target model and optimizer update with XLA, and turn on
+        XLA auto-clustering for the session.  Defaults to `False`.
+    :param nccl_all_reduce: When training on multiple GPUs, average gradients with an NCCL all-reduce between GPUs 
+        instead of on the CPU parameter server.  Best suited to systems with direct GPU interconnects.  Defaults to `False`.
+    :param use_fp16: Run the transformer blocks of the featurizer in float16 while keeping float32 master copies of the
+        weights.  Speeds up training on GPUs with tensor cores.  Defaults to `False`.
+    :param fp16_loss_scale: Constant factor the loss is scaled by before computing gradients when `use_fp16` is set, to
+        avoid underflow of small float16 gradients.  Defaults to `128.0`.
+    :param gpu_allow_growth: Allocate GPU memory as it is needed rather than reserving all of it when the session is
+        created, so that several models can share a GPU.  Set for the workers of a parallel grid search.  Defaults to `False`.
     :param allow_soft_placement: Allow tf to allocate an operation to a different device if a device is unavailable.  Defaults to `True`.
+    :param cache_dir: Directory that pre-trained weights adapted to `max_length` are cached in, so that they are only
+        computed once.  Each distinct `max_length` and `interpolate_pos_embed` setting takes about 120MB and cached
+        files are never removed.  Set to `None` to disable the cache.  Defaults to `~/.cache/finetune`.
     :param save_adam_vars: Save adam parameters when calling `model.save()`.  Defaults to `True`.
-    :param num_layers_trained: How many layers to finetune.  Specifying a value less than 12 will train layers starting from model output. Defaults to `12`.
+    :param num_layers_trained: How many layers to finetune.  Specifying a value less than 12 will train layers starting from model output.
+        The layers below are frozen: they receive no gradients, have no optimizer state and run without dropout.  `0`
+        trains the target model only.  Requires `train_embeddings=False` unless all layers are trained.  Defaults to `12`.
     :param train_embeddings: Should embedding layer be finetuned? Defaults to `True`.
     """
     def get_grid_searchable(self):
         return self.grid_searchable
 
+    def with_overrides(self, **kwargs):
+        """
+        Returns a copy of this config with the given values replaced.  Values that are not replaced are shared with
+        this config rather than copied.
+        """
+        config = Settings(**self)
+        config.update(kwargs)
+        return config
+
     def __init__(self, **kwargs):
         super().__init__()
         self.grid_searchable = {}
@@ -145,9 +174,16 @@ def get_default_config():
         subtoken_predictions=False,
         multi_label_threshold=0.5,
         autosave_path=None,
+        autosave_min_delta=0.,
         tensorboard_folder=None,
         log_device_placement=False,
         soft_device_placement=True,
+        nccl_all_reduce=False,
+        xla_jit=False,
+        use_fp16=False,
+        fp16_loss_scale=128.,
+        gpu_allow_growth=False,
+        cache_dir=CACHE_DIR,
         save_adam_vars=False,
         num_layers_trained=12,
         train_embeddings=True,
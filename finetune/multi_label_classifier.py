@@ -89,16 +89,11 @@ class MultiLabelClassifier(BaseModel):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
             max_length = max_length or self.config.max_length
-            for xmb, mmb in self._infer_prep(X, max_length=max_length):
-                output = self._eval(
-                    self.predict_op,
-                    feed_dict={
-                        self.X: xmb,
-                        self.M: mmb,
-                        self.do_dropout: DROPOUT_OFF,
-                        self.threshold_placeholder: threshold
-                    }
-                )
+            batches = self._infer_prep(X, max_length=max_length)
+            feed_dict = {self.do_dropout: DROPOUT_OFF, self.threshold_placeholder: threshold}
+            for xmb, mmb in batches:
+                feed_dict[self.X], feed_dict[self.M] = xmb, mmb
+                output = self._eval(self.predict_op, feed_dict=feed_dict)
                 prediction = output.get(self.predict_op)
                 formatted_predictions = self.label_encoder.inverse_transform(prediction)
                 predictions.extend(formatted_predictions)
@@ -61,6 +61,7 @@ class MultifieldClassifier(Classifier):
         """
         return BaseModel.featurize(self, Xs, max_length=max_length)
 
+    @classmethod
     def get_eval_fn(cls):
         return lambda labels, targets: np.mean(np.asarray(labels) == np.asarray(targets))
 
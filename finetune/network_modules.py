@@ -1,5 +1,5 @@
 from finetune.transformer import dropout, embed, block, attn, norm
-from finetune.utils import shape_list, merge_leading_dims
+from finetune.utils import shape_list, merge_leading_dims, float32_variable_storage_getter
 from finetune.recompute_grads import recompute_grad
 import functools
 import tensorflow as tf
@@ -55,20 +55,33 @@ def featurizer(X, encoder, dropout_placeholder, config, train=False, reuse=None,
         X = tf.reshape(X, [-1, max_length, 2])
 
         h = embed(X, embed_weights)
-        for layer in range(config.n_layer):
-            if (layer - config.n_layer) == config.num_layers_trained and config.num_layers_trained != 12:
+        if config.use_fp16:
+            # transformer blocks run in float16 against float32 master weights
+            h = tf.cast(h, tf.float16)
+            block_scope = tf.variable_scope(tf.get_variable_scope(), dtype=tf.float16,
+                                            custom_getter=float32_variable_storage_getter)
+        else:
+            block_scope = tf.variable_scope(tf.get_variable_scope())
+
+        first_trained_layer = config.n_layer - config.num_layers_trained
+        with block_scope:
+            for layer in range(config.n_layer):
+                if layer == first_trained_layer and layer > 0:
+                    # nothing below this layer is trained, so don't backprop into it
+                    h = tf.stop_gradient(h)
+                train_layer = train and layer >= first_trained_layer
+                with tf.variable_scope('h%d_' % layer):
+                    block_fn = functools.partial(block, n_head=config.n_heads, act_fn=config.act_fn,
+                                                 resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
+                                                 scope='h%d' % layer, dropout_placeholder=dropout_placeholder,
+                                                 train=train_layer, scale=True)
+                    if config.low_memory_mode and train_layer:
+                        block_fn = recompute_grad(block_fn, use_entire_scope=True)
+                    h = block_fn(h)
+            if first_trained_layer == config.n_layer:
+                # fully frozen featurizer: only the target head receives gradients
                 h = tf.stop_gradient(h)
-                train_layer = False
-            else:
-                train_layer = train
-            with tf.variable_scope('h%d_' % layer):
-                block_fn = functools.partial(block, n_head=config.n_heads, act_fn=config.act_fn,
-                                             resid_pdrop=config.resid_p_drop, attn_pdrop=config.attn_p_drop,
-                                             scope='h%d' % layer, dropout_placeholder=dropout_placeholder,
-                                             train=train_layer, scale=True)
-                if config.low_memory_mode and train_layer:
-                    block_fn = recompute_grad(block_fn, use_entire_scope=True)
-                h = block_fn(h)
+        h = tf.cast(h, tf.float32)
 
         # Use hidden state at classifier token as input to final proj. + softmax
         clf_h = tf.reshape(h, [-1, config.n_embed])  # [batch * seq_len, embed]
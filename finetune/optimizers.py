@@ -26,15 +26,22 @@ schedules = {
 }
 
 
-def AdamWeightDecay(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e-8, l2=0, vector_l2=False, max_grad_norm=-1, pretrained_weights=None, deviation_regularization=0, **kwargs):
+def AdamWeightDecay(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e-8, l2=0, vector_l2=False, max_grad_norm=-1, pretrained_weights=None, deviation_regularization=0, loss_scale=1., **kwargs):
     """
     Adam with weight decay fix and added weight decay to pre-trained weights.
+    Gradients are divided by loss_scale before clipping, to undo any scaling applied to the loss.
     """
     
     with tf.variable_scope('adam', reuse=tf.AUTO_REUSE):
         t = tf.get_variable("t", shape=1, initializer=tf.zeros_initializer() , dtype=tf.float32, trainable=False)
         tt = t + 1
         updates = [t.assign(tt)]
+        if loss_scale != 1.:
+            grads = [
+                tf.IndexedSlices(g.values / loss_scale, g.indices, g.dense_shape) if isinstance(g, tf.IndexedSlices)
+                else None if g is None else g / loss_scale
+                for g in grads
+            ]
         if max_grad_norm > 0:
             grads, _ = tf.clip_by_global_norm(grads, max_grad_norm)
 
@@ -56,7 +63,7 @@ def AdamWeightDecay(params, grads, lr, schedule, t_total, b1=0.9, b2=0.999, e=1e
 
                 update_vec = mt / (tf.sqrt(vt) + e)
 
-                if (len(p.get_shape()) > 1 or vector_l2) and l2 > 0:
+                if (len(p.get_shape()) > 1 or vector_l2) and (isinstance(l2, tf.Tensor) or l2 > 0):
                     update_vec += l2 * p
 
                 if deviation_regularization > 0.:
@@ -2,28 +2,107 @@ import re
 import os
 import warnings
 import json
+import hashlib
+import pickle
+import zipfile
 import joblib
 
-import itertools
-
 import numpy as np
 
 from finetune.utils import find_trainable_variables
+from finetune.config import CACHE_DIR, get_default_config
 
 import tensorflow as tf
 SHAPES_PATH = os.path.join(os.path.dirname(__file__), 'model', 'params_shapes.json')
 PARAM_PATH = os.path.join(os.path.dirname(__file__), 'model', 'params_{}.npy')
 SPECIAL_TOKEN_PATH = os.path.join(os.path.dirname(__file__), "model", "special_tokens.npy")
+METADATA_KEY = '__metadata__'
+# fallback weights already read in this process, by path
+_FALLBACK_CACHE = {}
+LABEL_ENCODER_KEY = '__label_encoder__'
+
+
+def load_base_params():
+    """
+    Reads the original pre-trained weights, which are stored flattened and concatenated across 10 shards.
+
+    Shards are memory mapped and each parameter is sliced out of them directly, so only parameters that straddle a
+    shard boundary are copied rather than the whole concatenated array being materialised and then split.
+    """
+    with open(SHAPES_PATH) as shapes_file:
+        shapes = json.load(shapes_file)
+    shards = [np.load(PARAM_PATH.format(n), mmap_mode='r') for n in range(10)]
+    shard_starts = np.cumsum([0] + [len(shard) for shard in shards])
+
+    params = []
+    start = 0
+    for shape in shapes:
+        end = start + int(np.prod(shape))
+        if end == start:
+            # an empty parameter, its position may be past the last shard
+            params.append(np.empty(shape, dtype=shards[0].dtype))
+            continue
+        first = np.searchsorted(shard_starts, start, side='right') - 1
+        last = np.searchsorted(shard_starts, end, side='left') - 1
+        pieces = [
+            shards[i][max(start - shard_starts[i], 0): end - shard_starts[i]]
+            for i in range(first, last + 1)
+        ]
+        param = pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+        params.append(param.reshape(shape))
+        start = end
+    return params
+
+
+def _with_defaults(saved_config):
+    """
+    Settings added since a model was saved take their default values.
+    """
+    config = get_default_config()
+    config.update(saved_config)
+    return config
+
+
+def _to_bytes_array(data):
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def _json_default(value):
+    # config values may have been set from numpy scalars or arrays
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
 
 
 class Saver:
-    def __init__(self, fallback_filename, include_matches=None, exclude_matches=None, variable_transforms=None, save_dtype=None):
+    def __init__(self, fallback_filename, include_matches=None, exclude_matches=None, variable_transforms=None,
+                 save_dtype=None, mmap_mode='r', transform_key=None, cache_dir=CACHE_DIR):
+        """
+        :param mmap_mode: Passed through to `joblib.load` when reading the fallback weights, so that they are memory
+            mapped rather than read into memory in full.  Set to None to disable.
+        :param transform_key: A function returning a value with a stable repr that fully determines the current output of
+            `variable_transforms`.  It is called on every lookup, so the key follows changes to what it depends on.
+            When given, transformed fallback weights are cached in `cache_dir` under this key.
+        :param cache_dir: Directory for cached transformed fallback weights, or None to disable the cache.
+        """
         self.variable_transforms = variable_transforms or []
         self.fallback_filename = fallback_filename
+        # resolved once, it is part of the cache keys looked up for every variable that is initialized
+        self._fallback_path = None if fallback_filename is None else os.path.abspath(fallback_filename)
+        self.mmap_mode = mmap_mode
+        self.transform_key = transform_key
+        self.cache_dir = cache_dir
         self.include = None if include_matches is None else re.compile(include_matches)
         self.exclude = None if exclude_matches is None else re.compile(exclude_matches)
         self.variables = None
         self.save_dtype = save_dtype
+        # when set, the initialization ops run by `initialize` and the values they were fed are kept for `reset`
+        self.keep_initial_values = False
+        self.init_ops = []
+        self.init_feed = {}
+        self._variable_split = None  # (graph, number of variables), included and excluded variables
 
     def save(self, finetune_obj, path, mkdir=True):
         folder = os.path.dirname(path)
@@ -32,7 +111,7 @@ class Saver:
         if self.fallback_filename is None:
             fallback = dict()
         else:
-            fallback = joblib.load(self.fallback_filename)
+            fallback = self._load_fallback()
         included, excluded = self.find_trainable_variables()
 
         if not all(var.name in fallback for var in excluded):
@@ -46,21 +125,41 @@ class Saver:
         var_names = [var.name for var in vars_reduced]
         var_dict = dict(zip(var_names, vals_reduced))
         assert len(vals_reduced) == len(var_names) == len(var_dict)
-        joblib.dump((var_dict, finetune_obj), path)
+
+        state = finetune_obj.__getstate__()
+        label_encoder = state.pop('label_encoder', None)
+        var_dict[METADATA_KEY] = _to_bytes_array(json.dumps(state, default=_json_default).encode('utf-8'))
+        if label_encoder is not None:
+            var_dict[LABEL_ENCODER_KEY] = _to_bytes_array(pickle.dumps(label_encoder))
+        # np.savez appends a .npz extension to string paths, so write through a file object
+        with open(path, 'wb') as f:
+            np.savez(f, **var_dict)
 
     def load(self, path):
-        self.variables, finetune_obj = joblib.load(path)
-        return finetune_obj
+        """
+        Reads a file written by `save`.
+
+        :return: The serialized attributes of the saved model, to be set on a new instance.
+        """
+        if not zipfile.is_zipfile(path):
+            # models saved before the archive format was introduced pickle the whole model object
+            self.variables, finetune_obj = joblib.load(path)
+            state = finetune_obj.__dict__
+            state['config'] = _with_defaults(state['config'])
+            return state
+
+        with np.load(path, allow_pickle=False) as archive:
+            self.variables = {name: archive[name] for name in archive.files if not name.startswith('__')}
+            state = json.loads(archive[METADATA_KEY].tobytes().decode('utf-8'))
+            state['config'] = _with_defaults(state['config'])
+            if LABEL_ENCODER_KEY in archive.files:
+                state['label_encoder'] = pickle.loads(archive[LABEL_ENCODER_KEY].tobytes())
+        return state
 
     def _save_fallback(self):
-        with open(SHAPES_PATH) as shapes_file:
-            shapes = json.load(shapes_file)
-            offsets = np.cumsum([np.prod(shape) for shape in shapes])
-            init_params = [np.load(PARAM_PATH.format(n)) for n in range(10)]
-            init_params = np.split(np.concatenate(init_params, 0), offsets)[:-1]
-            init_params = [param.reshape(shape) for param, shape in zip(init_params, shapes)]
-            init_params[0] = np.load(os.path.join(os.path.dirname(__file__), "model", "embeddings.npy"))
-            del init_params[1]
+        init_params = load_base_params()
+        init_params[0] = np.load(os.path.join(os.path.dirname(__file__), "model", "embeddings.npy"))
+        del init_params[1]
         var_dict = dict(zip((var.name for var in find_trainable_variables("model", exclude="model/target")), init_params))
         joblib.dump(var_dict, self.fallback_filename)
 
@@ -71,7 +170,7 @@ class Saver:
         :param expect_new_variables:
         :return:
         """
-        variables_fb = joblib.load(self.fallback_filename)
+        variables_fb = self._load_fallback()
 
         if self.variables is not None:
             variables_sv = self.variables
@@ -81,32 +180,137 @@ class Saver:
         all_vars = tf.global_variables()
         uninit_variables = [v for s, v in zip(sess.run([tf.is_variable_initialized(t) for t in all_vars]), all_vars) if not s]
         init_vals = []
+        init_feed = {}
+        fresh_vars = []  # (variable, initializer op) of variables drawn from their initializers
         for var in uninit_variables:
-            var_init = None
-            for saved_var_name, saved_var in itertools.chain(variables_sv.items(), variables_fb.items()):
-                if saved_var_name == var.name:
-                    var_init = (var, saved_var)
-                    break
-            
-            if var_init is None and expect_new_variables:
-                init_vals.append(tf.initialize_variables([var]))
+            # the saved model's value takes precedence, and the initializer is only used if no value fits
+            saved_var = None
+            if var.name in variables_sv:
+                saved_var = self._fitting_value(
+                    var, self._transform(var.name, variables_sv[var.name]), "saved model",
+                    "the fallback value" if var.name in variables_fb else "its initializer"
+                )
+            if saved_var is None and var.name in variables_fb:
+                saved_var = self._fitting_value(
+                    var, self._transform_fallback(var.name, variables_fb[var.name], var.get_shape().as_list()),
+                    "fallback", "its initializer"
+                )
+
+            if saved_var is None and expect_new_variables:
+                init_vals.append(tf.variables_initializer([var]))
+                fresh_vars.append((var, init_vals[-1]))
             
-            elif var_init is None and not expect_new_variables:
+            elif saved_var is None and not expect_new_variables:
                 warnings.warn(
                     "Var {} is not found in any checkpoint. Because expect_new_variables is True. This variable will remain uninitialized".format(
                         var.name))
             
             else:
-                var, saved_var = var_init
-                for func in self.variable_transforms:
-                    saved_var = func(var.name, saved_var)
-                init_vals.append(var.assign(saved_var))
-        
-        sess.run(init_vals)
+                # feed values through a placeholder rather than embedding them in the graph as constants
+                value_placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                init_vals.append(var.assign(value_placeholder))
+                init_feed[value_placeholder] = saved_var
+
+        sess.run(init_vals, feed_dict=init_feed)
+        if self.keep_initial_values:
+            self._keep_initial_values(sess, init_vals, init_feed, fresh_vars)
         self.variables = None # not an explicit del but should set reference count to 0 unless being used for deviation regularisation
 
+    @staticmethod
+    def _fitting_value(var, value, source, replacement):
+        """
+        Returns :param value: if it has the shape of :param var:, otherwise warns and returns None.
+        """
+        if np.shape(value) == tuple(var.get_shape().as_list()):
+            return value
+        warnings.warn("The {} value of {} has shape {} but the variable has shape {}, using {} instead.".format(
+            source, var.name, np.shape(value), var.get_shape(), replacement))
+        return None
+
+    def _keep_initial_values(self, sess, init_vals, init_feed, fresh_vars):
+        """
+        Keeps the ops and values needed by `reset`.  Random initializers are stateful and would draw new values if run
+        again, so the values drawn for `fresh_vars` are read back and reassigned through placeholders instead.
+        Variables initialized to all zeros, such as optimizer slots, keep their initializer to avoid holding a copy.
+        """
+        fresh_values = sess.run([var for var, _ in fresh_vars])
+        reassigned = set()
+        for (var, initializer), value in zip(fresh_vars, fresh_values):
+            if not value.any():
+                continue
+            value_placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+            self.init_ops.append(var.assign(value_placeholder))
+            self.init_feed[value_placeholder] = value
+            reassigned.add(initializer)
+        self.init_ops.extend(op for op in init_vals if op not in reassigned)
+        self.init_feed.update(init_feed)
+
+    def reset(self, sess):
+        """
+        Returns every variable set up by `initialize` to the value it was initialized with, including variables that
+        were drawn from random initializers.
+        Requires `keep_initial_values` to have been set before the variables were initialized.
+        """
+        sess.run(self.init_ops, feed_dict=self.init_feed)
+
+    def release(self):
+        """
+        Drops the ops and variables kept from the graph of the model being saved, so that the graph can be freed.
+        """
+        self.init_ops = []
+        self.init_feed = {}
+        self._variable_split = None
+
     def get_pretrained_weights(self):
-        return joblib.load(self.fallback_filename)
+        return self._load_fallback()
+
+    def _load_fallback(self):
+        """
+        Fallback weights are read once per process and shared between savers, as every model built in a process (for
+        instance during a grid search) starts from the same file.  The cache is invalidated if the file changes.
+        """
+        path = self._fallback_path
+        fallback_stat = os.stat(path)
+        key = (fallback_stat.st_size, fallback_stat.st_mtime, self.mmap_mode)
+        cached = _FALLBACK_CACHE.get(path)
+        if cached is None or cached[0] != key:
+            cached = (key, joblib.load(path, mmap_mode=self.mmap_mode))
+            _FALLBACK_CACHE[path] = cached
+        return cached[1]
+
+    def _transform(self, name, value):
+        for func in self.variable_transforms:
+            value = func(name, value)
+        return value
+
+    def _transform_fallback(self, name, value, shape=None):
+        """
+        Applies `variable_transforms` to a fallback weight.  Fallback weights never change, so when a
+        `transform_key` is set any weight that is modified by the transforms is cached on disk and memory mapped
+        on later calls.  A cached weight that does not have the expected :param shape: is recomputed.
+        """
+        if self.transform_key is None or self.cache_dir is None:
+            return self._transform(name, value)
+
+        fallback_stat = os.stat(self._fallback_path)
+        key = (self._fallback_path, fallback_stat.st_size, fallback_stat.st_mtime, name, self.transform_key())
+        cache_path = os.path.join(self.cache_dir, "{}.npy".format(hashlib.sha1(repr(key).encode()).hexdigest()))
+        if os.path.exists(cache_path):
+            cached = np.load(cache_path, mmap_mode=self.mmap_mode)
+            if shape is None or cached.shape == tuple(shape):
+                return cached
+
+        transformed = self._transform(name, value)
+        if transformed is not value:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+                with open(tmp_path, 'wb') as tmp_file:
+                    np.save(tmp_file, transformed)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                warnings.warn("Unable to cache transformed weights for {}: {}".format(name, e))
+        return transformed
 
     def remove_unchanged(self, variables, variable_values, fallback_vars):
         skips = []
@@ -114,8 +318,7 @@ class Saver:
             skip = False
             for fb_var_name, fb_var in fallback_vars.items():
                 if fb_var_name == var.name:
-                    for func in self.variable_transforms:
-                        fb_var = func(var.name, fb_var)
+                    fb_var = self._transform_fallback(var.name, fb_var, var.get_shape().as_list())
                     if np.allclose(fb_var, var_val):
                         skip = True
                         break
@@ -127,7 +330,12 @@ class Saver:
 
     def find_trainable_variables(self):
         trainable_variables = tf.global_variables()
-        included = [var for var in trainable_variables if (self.include is None or self.include.match(var.name)) and (
-                self.exclude is None or not self.exclude.match(var.name))]
-        excluded = [var for var in trainable_variables if var not in set(included)]
-        return included, excluded
+        # variables are only ever added to a graph, so the split is redone only when the graph or its size changes
+        key = (tf.get_default_graph(), len(trainable_variables))
+        if self._variable_split is None or self._variable_split[0] != key:
+            included = [var for var in trainable_variables if (self.include is None or self.include.match(var.name)) and (
+                    self.exclude is None or not self.exclude.match(var.name))]
+            included_set = set(included)
+            excluded = [var for var in trainable_variables if var not in included_set]
+            self._variable_split = (key, included, excluded)
+        return self._variable_split[1], self._variable_split[2]
@@ -58,14 +58,11 @@ class SequenceLabeler(BaseModel):
         with warnings.catch_warnings():
             warnings.filterwarnings("ignore")
             max_length = max_length or self.config.max_length
-            for xmb, mmb in self._infer_prep(doc_subseqs, max_length=max_length):
-                output = self._eval(self.predict_op,
-                    feed_dict={
-                        self.X: xmb,
-                        self.M: mmb,
-                        self.do_dropout: DROPOUT_OFF
-                    }
-                )
+            batches = self._infer_prep(doc_subseqs, max_length=max_length)
+            feed_dict = {self.do_dropout: DROPOUT_OFF}
+            for xmb, mmb in batches:
+                feed_dict[self.X], feed_dict[self.M] = xmb, mmb
+                output = self._eval(self.predict_op, feed_dict=feed_dict)
                 prediction, probas = output.get(self.predict_op)
                 batch_probas.extend(probas)
                 formatted_predictions = self.label_encoder.inverse_transform(prediction)
@@ -10,24 +10,28 @@ def norm(x, scope, axis=[-1], e=1e-5):
         n_state = shape_list(x)[-1]
         g = tf.get_variable("g", [n_state], initializer=tf.constant_initializer(1))
         b = tf.get_variable("b", [n_state], initializer=tf.constant_initializer(0))
+        # statistics are computed in float32 even when running in reduced precision
+        dtype = x.dtype
+        x, g, b = (tf.cast(t, tf.float32) for t in (x, g, b))
         u = tf.reduce_mean(x, axis=axis, keepdims=True)
         s = tf.reduce_mean(tf.square(x - u), axis=axis, keepdims=True)
         x = (x - u) * tf.rsqrt(s + e)
         x = x * g + b
-        return x
+        return tf.cast(x, dtype)
 
 
 def dropout(x, pdrop, train, dropout_placeholder):
     if train and pdrop > 0:
-        x = tf.nn.dropout(x, 1 - (pdrop * dropout_placeholder))
+        x = tf.nn.dropout(x, tf.cast(1 - (pdrop * dropout_placeholder), x.dtype))
     return x
 
 
 def mask_attn_weights(w):
     n = shape_list(w)[-1]
-    b = tf.matrix_band_part(tf.ones([n, n]), -1, 0)
+    b = tf.matrix_band_part(tf.ones([n, n], dtype=w.dtype), -1, 0)
     b = tf.reshape(b, [1, 1, n, n])
-    w = w * b + -1e9 * (1 - b)
+    # -1e9 is not representable in float16
+    w = w * b + (-1e9 if w.dtype == tf.float32 else -1e4) * (1 - b)
     return w
 
 
@@ -36,7 +40,7 @@ def _attn(q, k, v, attn_pdrop, dropout_placeholder, train=False, scale=False, ma
 
     if scale:
         n_state = shape_list(v)[-1]
-        w = w * tf.rsqrt(tf.cast(n_state, tf.float32))
+        w = w * tf.rsqrt(tf.cast(n_state, w.dtype))
 
     if mask:
         w = mask_attn_weights(w)
@@ -11,6 +11,11 @@ from tqdm import tqdm
 from scipy import interpolate
 from sklearn.utils import shuffle
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 from finetune.encoding import NLP
 from finetune import config
 
@@ -140,6 +145,21 @@ def find_trainable_variables(key, exclude=None):
     return trainable_variables
 
 
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None,
+                                    trainable=True, *args, **kwargs):
+    """
+    Custom variable getter for mixed precision training. Trainable variables are always stored in float32 and cast to
+    the dtype requested by the enclosing variable scope at the point of use, so that optimizer updates are applied to
+    float32 master weights.
+    """
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, initializer=initializer, regularizer=regularizer,
+                      trainable=trainable, *args, **kwargs)
+    if trainable and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
 def soft_split(*xs, n_splits=None):
     """
     Similar to tf.split but can accommodate batches that are not evenly divisible by n_splits.
@@ -172,6 +192,42 @@ def list_transpose(l):
     return [list(i) for i in zip(*l)]
 
 
+def ragged_coords(lengths, offsets):
+    """
+    Gives the (row, column) coordinates of every item of a flattened ragged array, where sequence i starts at
+    :param offsets:[i] and has :param lengths:[i] items, when the sequences are laid out densely one per row.
+    """
+    row_idx = np.repeat(np.arange(len(lengths)), lengths)
+    col_idx = np.arange(np.sum(lengths)) - np.repeat(offsets, lengths)
+    return row_idx, col_idx
+
+
+def _fill_token_array(x, mask, flat_tokens, offsets, lengths):
+    """
+    Copies the flattened token ids of each sequence into channel 0 of :param x: and marks all but the first position
+    of each sequence in :param mask:.  Both output arrays are written in place.
+    """
+    for i in numba.prange(lengths.shape[0]):
+        start = offsets[i]
+        for j in range(lengths[i]):
+            x[i, j, 0] = flat_tokens[start + j]
+            if j > 0:
+                mask[i, j] = 1.0
+
+
+# only available when numba is installed, callers should fall back to `fill_token_array_numpy` otherwise
+fill_token_array = None if numba is None else numba.njit(cache=True, parallel=True)(_fill_token_array)
+
+
+def fill_token_array_numpy(x, mask, flat_tokens, offsets, lengths):
+    """
+    Numpy equivalent of `fill_token_array`, writes the same values into :param x: and :param mask: in place.
+    """
+    x[ragged_coords(lengths, offsets) + (0,)] = flat_tokens
+    positions = np.arange(x.shape[1])
+    mask[:] = (positions >= 1) & (positions < lengths[:, None])
+
+
 def iter_data(*datas, n_batch=128, truncate=False, verbose=False, max_batches=float("inf"), tqdm_desc=None):
     n = len(datas[0])
     if truncate:
@@ -280,6 +336,30 @@ def average_grads(tower_grads):
     return average_grads
 
 
+def all_reduce_grads(tower_grads):
+    """
+    Averages gradients across towers with an NCCL all-reduce, so that dense gradients are summed GPU to GPU rather
+    than being gathered on a parameter server first. Sparse or missing gradients fall back to :func:`average_grads`.
+
+    Takes and returns the same format as :func:`average_grads`.
+    """
+    from tensorflow.contrib import nccl
+
+    reduced_grads = []
+    for grad_and_vars in zip(*tower_grads):
+        grads = [g for g, _ in grad_and_vars]
+        if len(grads) == 1 or grads[0] is None or isinstance(grads[0], tf.IndexedSlices):
+            reduced_grads.extend(average_grads([[grad_and_var] for grad_and_var in grad_and_vars]))
+            continue
+
+        summed = nccl.all_sum(grads)
+        # every device's all-reduce op has to run for any of them to complete
+        with tf.control_dependencies(summed):
+            grad = tf.identity(summed[0]) / len(grads)
+        reduced_grads.append((grad, grad_and_vars[0][1]))
+    return reduced_grads
+
+
 def sequence_decode(logits, transition_matrix):
     """ A simple py_func wrapper around the Viterbi decode allowing it to be included in the tensorflow graph. """
 
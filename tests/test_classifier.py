@@ -13,11 +13,13 @@ warnings.filterwarnings('ignore')
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 import tensorflow as tf
+import joblib
 import pandas as pd
 import numpy as np
 from sklearn.metrics import accuracy_score
 
 from finetune import Classifier
+from finetune.base import _grid_search_trial, _MedianPruner
 from finetune.datasets import generic_download
 from finetune.config import get_config
 
@@ -145,6 +147,42 @@ class TestClassifier(unittest.TestCase):
         for i, prediction in enumerate(predictions):
             self.assertEqual(prediction, new_predictions[i])
 
+    def test_save_load_metadata(self):
+        """
+        Ensure the config, including grid searchable values, survives the JSON metadata of a saved model
+        Ensure the label encoder survives saving + loading
+        """
+        save_file = 'tests/saved-models/test-save-load'
+        model = Classifier(config=self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text, train_sample.Target)
+        model.save(save_file)
+        loaded = Classifier.load(save_file)
+        self.assertEqual(dict(loaded.config), dict(model.config))
+        self.assertEqual(loaded.config.get_grid_searchable(), model.config.get_grid_searchable())
+        self.assertEqual(list(loaded.label_encoder.classes_), list(model.label_encoder.classes_))
+
+    def test_load_legacy_format(self):
+        """
+        Ensure models saved as a joblib pickle, before the numpy archive format, can still be loaded
+        """
+        save_file = 'tests/saved-models/test-save-load'
+        legacy_file = 'tests/saved-models/test-save-load-legacy'
+        model = Classifier(config=self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text, train_sample.Target)
+        predictions = model.predict(valid_sample.Text)
+        model.save(save_file)
+        # the legacy format pickled the saved variables alongside the model itself
+        with np.load(save_file) as archive:
+            variables = {name: archive[name] for name in archive.files if not name.startswith('__')}
+        joblib.dump((variables, model), legacy_file)
+        model = Classifier.load(legacy_file)
+        new_predictions = model.predict(valid_sample.Text)
+        for i, prediction in enumerate(predictions):
+            self.assertEqual(prediction, new_predictions[i])
+
     def test_featurize(self):
         """
         Ensure featurization returns an array of the right shape
@@ -213,6 +251,27 @@ class TestClassifier(unittest.TestCase):
         lm_out = model.generate_text()
         self.assertEqual(lm_out, '_start__classify_')
 
+    def test_num_layers_trained(self):
+        """
+        Ensure layers below num_layers_trained get no gradients and no Adam slots
+        Ensure the trained layers do get Adam slots
+        """
+        model = Classifier(config=self.default_config(max_length=16, num_layers_trained=1, train_embeddings=False))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text, train_sample.Target)
+        with model.graph.as_default():
+            variables = tf.global_variables()
+            frozen = [
+                var for var in variables
+                if var.name == 'model/featurizer/we:0' or var.name.startswith('model/featurizer/h0_/')
+            ]
+            self.assertTrue(frozen)
+            self.assertTrue(all(grad is None for grad in tf.gradients(model.target_loss, frozen)))
+        variable_names = [var.name for var in variables]
+        self.assertFalse(any(name.startswith('adam/model/featurizer/h0_/') for name in variable_names))
+        self.assertNotIn('adam/model/featurizer/we_m:0', variable_names)
+        self.assertTrue(any(name.startswith('adam/model/featurizer/h11_/') for name in variable_names))
+
     def test_validation(self):
         """
         Ensure validation settings do not result in an error
@@ -221,3 +280,97 @@ class TestClassifier(unittest.TestCase):
         model = Classifier(config=config)
         train_sample = self.dataset.sample(n=20)
         model.fit(train_sample.Text, train_sample.Target)
+
+    def test_grid_search_prune(self):
+        """
+        Ensure a pruned trial stops training before n_epochs
+        Ensure a pruned trial is not recorded as completed
+        """
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model = Classifier(config=self.default_config(max_length=16, n_epochs=3))
+        pruner = MagicMock()
+        pruner.should_prune = MagicMock(return_value=True)
+        score = _grid_search_trial(
+            model, [train_sample.Text], train_sample.Target, [valid_sample.Text], valid_sample.Target,
+            accuracy_score, probs=False, pruner=pruner
+        )
+        pruner.should_prune.assert_called_once_with(1, score)
+        pruner.complete.assert_not_called()
+
+    def test_median_pruner(self):
+        """
+        Ensure trials are only pruned once enough trials completed, and only if below the median at that epoch
+        """
+        pruner = _MedianPruner(n_startup_trials=2)
+        pruner.complete([0.5, 0.6])
+        self.assertFalse(pruner.should_prune(1, 0.0))
+        pruner.complete([0.7, 0.8])
+        self.assertTrue(pruner.should_prune(1, 0.5))
+        self.assertFalse(pruner.should_prune(1, 0.7))
+        self.assertFalse(pruner.should_prune(3, 0.0))
+
+    def grid_search_config(self, lrs, **kwargs):
+        """
+        A small config that grid searches over `lrs` only
+        """
+        config = self.default_config(max_length=16, **kwargs)
+        config.grid_searchable = {'lr': lrs}
+        return config
+
+    def test_grid_search_return_all(self):
+        """
+        Ensure return_all keeps grid order and pairs each config with its own score
+        """
+        train_sample = self.dataset.sample(n=self.n_sample)
+        lrs = [6.25e-4, 6.25e-5]
+        n_evaluated = []
+
+        def eval_fn(predictions, targets):
+            # scores each trial with the order it was evaluated in
+            n_evaluated.append(len(predictions))
+            return float(len(n_evaluated) - 1)
+
+        results = Classifier.finetune_grid_search(
+            list(train_sample.Text), list(train_sample.Target), test_size=0.5, config=self.grid_search_config(lrs),
+            eval_fn=eval_fn, return_all=True
+        )
+        self.assertEqual([config.lr for config, _ in results], lrs)
+        self.assertEqual([score for _, score in results], [0.0, 1.0])
+
+    def test_grid_search_random(self):
+        """
+        Ensure random search tries n_trials distinct combinations
+        Ensure the same combinations are drawn for the same seed
+        """
+        train_sample = self.dataset.sample(n=self.n_sample)
+        lrs = [6.25e-4, 6.25e-5, 6.25e-6, 6.25e-7]
+
+        def searched_lrs():
+            results = Classifier.finetune_grid_search(
+                list(train_sample.Text), list(train_sample.Target), test_size=0.5,
+                config=self.grid_search_config(lrs), eval_fn=accuracy_score, return_all=True,
+                search_strategy="random", n_trials=2
+            )
+            return [config.lr for config, _ in results]
+
+        first_lrs = searched_lrs()
+        self.assertEqual(len(first_lrs), 2)
+        self.assertEqual(len(set(first_lrs)), 2)
+        self.assertTrue(set(first_lrs) <= set(lrs))
+        self.assertEqual(searched_lrs(), first_lrs)
+
+    def test_grid_search_score_upper_bound(self):
+        """
+        Ensure a config whose upper bound cannot beat the best score is skipped and reported as -inf
+        """
+        train_sample = self.dataset.sample(n=self.n_sample)
+        lrs = [6.25e-4, 6.25e-5]
+        results = Classifier.finetune_grid_search(
+            list(train_sample.Text), list(train_sample.Target), test_size=0.5, config=self.grid_search_config(lrs),
+            eval_fn=accuracy_score, return_all=True,
+            # accuracy is never negative, so the second config can never beat the first
+            score_upper_bound=lambda config: 1.0 if config.lr == lrs[0] else -1.0
+        )
+        self.assertGreaterEqual(results[0][1], 0.0)
+        self.assertEqual(results[1][1], -np.inf)
@@ -0,0 +1,84 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import warnings
+
+# prevent excessive warning logs
+warnings.filterwarnings('ignore')
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import numpy as np
+
+from finetune.saver import load_base_params
+
+
+class TestLoadBaseParams(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_shards(self, shapes, shard_sizes):
+        """
+        Writes `shapes` and random parameters split into shards of `shard_sizes`, laid out as the pre-trained weights are
+        """
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        self.assertEqual(sum(sizes), sum(shard_sizes))
+        flat = np.random.RandomState(0).randn(sum(sizes)).astype(np.float32)
+        shape_path = os.path.join(self.folder, 'params_shapes.json')
+        param_path = os.path.join(self.folder, 'params_{}.npy')
+        with open(shape_path, 'w') as shape_file:
+            json.dump(shapes, shape_file)
+        for n, shard in enumerate(np.split(flat, np.cumsum(shard_sizes)[:-1])):
+            np.save(param_path.format(n), shard)
+
+        # the original implementation: concatenate every shard, then split
+        expected = np.split(flat, np.cumsum(sizes)[:-1])
+        expected = [param.reshape(shape) for param, shape in zip(expected, shapes)]
+        return shape_path, param_path, expected
+
+    def assert_matches_concat(self, shapes, shard_sizes):
+        shape_path, param_path, expected = self.write_shards(shapes, shard_sizes)
+        with patch('finetune.saver.SHAPES_PATH', shape_path), patch('finetune.saver.PARAM_PATH', param_path):
+            params = load_base_params()
+        self.assertEqual(len(params), len(expected))
+        for param, expected_param in zip(params, expected):
+            self.assertEqual(param.shape, expected_param.shape)
+            np.testing.assert_array_equal(param, expected_param)
+
+    def test_aligned_shards(self):
+        """
+        Ensure parameters that fill whole shards are read correctly
+        """
+        self.assert_matches_concat([[2, 3]] * 10, [6] * 10)
+
+    def test_straddling_shards(self):
+        """
+        Ensure parameters that straddle one or several shard boundaries are read correctly
+        """
+        shapes = [[5], [3, 4], [1], [7, 2], [2, 2, 2], [9], [4]]
+        self.assert_matches_concat(shapes, [4, 4, 10, 1, 6, 3, 12, 5, 2, 6])
+
+    def test_empty_shards_and_params(self):
+        """
+        Ensure empty shards and parameters with no elements are read correctly
+        """
+        shapes = [[0], [3], [0, 2], [6], [1]]
+        self.assert_matches_concat(shapes, [0, 2, 0, 0, 5, 0, 1, 2, 0, 0])
+
+    def test_random_layouts(self):
+        """
+        Ensure parameters are read correctly for random parameter shapes and shard sizes
+        """
+        rng = np.random.RandomState(1)
+        for _ in range(10):
+            shapes = [[int(rng.randint(1, 5)), int(rng.randint(1, 5))] for _ in range(rng.randint(1, 15))]
+            total = sum(int(np.prod(shape)) for shape in shapes)
+            cuts = np.sort(rng.randint(0, total + 1, size=9))
+            shard_sizes = np.diff(np.concatenate([[0], cuts, [total]])).tolist()
+            self.assert_matches_concat(shapes, shard_sizes)
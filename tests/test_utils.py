@@ -0,0 +1,140 @@
+import os
+import unittest
+from types import SimpleNamespace
+import warnings
+
+# prevent excessive warning logs
+warnings.filterwarnings('ignore')
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import numpy as np
+
+from finetune.base import BaseModel
+from finetune.config import get_config
+from finetune.encoding import EncodedOutput
+from finetune.utils import ragged_coords, fill_token_array, fill_token_array_numpy
+
+
+def loop_coords(lengths):
+    """
+    Reference (row, column) coordinates of a ragged array, built one item at a time
+    """
+    rows, cols = [], []
+    for i, length in enumerate(lengths):
+        rows.extend([i] * length)
+        cols.extend(range(length))
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+
+def loop_fill(lengths, flat_tokens, max_length):
+    """
+    Reference token and mask arrays, filled one sequence at a time
+    """
+    x = np.zeros((len(lengths), max_length, 2), dtype=np.int32)
+    mask = np.zeros((len(lengths), max_length), dtype=np.float32)
+    start = 0
+    for i, length in enumerate(lengths):
+        x[i, :length, 0] = flat_tokens[start:start + length]
+        mask[i, 1:length] = 1
+        start += length
+    return x, mask
+
+
+def ragged_batch(lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    flat_tokens = np.arange(1, lengths.sum() + 1, dtype=np.int32)
+    return lengths, offsets, flat_tokens
+
+
+class TestRaggedCoords(unittest.TestCase):
+
+    def assert_matches_loop(self, lengths):
+        lengths, offsets, _ = ragged_batch(lengths)
+        row_idx, col_idx = ragged_coords(lengths, offsets)
+        expected_rows, expected_cols = loop_coords(lengths)
+        np.testing.assert_array_equal(row_idx, expected_rows)
+        np.testing.assert_array_equal(col_idx, expected_cols)
+
+    def test_empty_batch(self):
+        """
+        Ensure an empty batch gives no coordinates
+        """
+        self.assert_matches_loop([])
+
+    def test_zero_length_sequences(self):
+        """
+        Ensure empty sequences take up a row but give no coordinates
+        """
+        self.assert_matches_loop([0, 3, 0, 0, 2, 0])
+        self.assert_matches_loop([0, 0])
+
+    def test_random_lengths(self):
+        """
+        Ensure coordinates match the per-sequence loop on random batches
+        """
+        rng = np.random.RandomState(0)
+        for _ in range(20):
+            self.assert_matches_loop(rng.randint(0, 10, size=rng.randint(1, 20)))
+
+
+class TestFillTokenArray(unittest.TestCase):
+    max_length = 12
+
+    def fill(self, fill_fn, lengths, offsets, flat_tokens):
+        x = np.zeros((len(lengths), self.max_length, 2), dtype=np.int32)
+        mask = np.zeros((len(lengths), self.max_length), dtype=np.float32)
+        fill_fn(x, mask, flat_tokens, offsets, lengths)
+        return x, mask
+
+    def random_batches(self):
+        rng = np.random.RandomState(0)
+        yield []
+        yield [0, 0, 0]
+        yield [self.max_length, 0, 1]
+        for _ in range(20):
+            yield rng.randint(0, self.max_length + 1, size=rng.randint(1, 20))
+
+    def test_numpy_matches_loop(self):
+        """
+        Ensure the numpy fallback fills the same tokens and mask as the per-sequence loop
+        """
+        for lengths in self.random_batches():
+            lengths, offsets, flat_tokens = ragged_batch(lengths)
+            x, mask = self.fill(fill_token_array_numpy, lengths, offsets, flat_tokens)
+            expected_x, expected_mask = loop_fill(lengths, flat_tokens, self.max_length)
+            np.testing.assert_array_equal(x, expected_x)
+            np.testing.assert_array_equal(mask, expected_mask)
+
+    @unittest.skipIf(fill_token_array is None, "numba is not installed")
+    def test_numba_matches_numpy(self):
+        """
+        Ensure the numba kernel fills the same tokens and mask as the numpy fallback
+        """
+        for lengths in self.random_batches():
+            lengths, offsets, flat_tokens = ragged_batch(lengths)
+            x, mask = self.fill(fill_token_array, lengths, offsets, flat_tokens)
+            expected_x, expected_mask = self.fill(fill_token_array_numpy, lengths, offsets, flat_tokens)
+            np.testing.assert_array_equal(x, expected_x)
+            np.testing.assert_array_equal(mask, expected_mask)
+
+    def test_array_format_matches_loop(self):
+        """
+        Ensure _array_format fills the same tokens, mask and positions as the per-sequence loop
+        Ensure sequences longer than max_length are rejected
+        """
+        vocab_size = 100
+        model = SimpleNamespace(
+            config=get_config(max_length=self.max_length), encoder=SimpleNamespace(vocab_size=vocab_size), _pos_row=None
+        )
+        for lengths in self.random_batches():
+            lengths, offsets, flat_tokens = ragged_batch(lengths)
+            token_ids = [flat_tokens[start:start + length].tolist() for start, length in zip(offsets, lengths)]
+            arr_encoded = BaseModel._array_format(model, EncodedOutput(token_ids=token_ids))
+            expected_x, expected_mask = loop_fill(lengths, flat_tokens, self.max_length)
+            expected_x[:, :, 1] = np.arange(vocab_size, vocab_size + self.max_length)
+            np.testing.assert_array_equal(arr_encoded.token_ids, expected_x)
+            np.testing.assert_array_equal(arr_encoded.mask, expected_mask)
+
+        with self.assertRaises(ValueError):
+            BaseModel._array_format(model, EncodedOutput(token_ids=[list(range(self.max_length + 1))]))